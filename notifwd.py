@@ -6,22 +6,64 @@
 
 __version__ = "0.5"
 
+# requests, concurrent.futures and PyObjC are imported where they're first needed,
+# so --help and --version don't have to wait for them to load.
 import subprocess, sqlite3
-from datetime import datetime
+import json, os, shutil
 import plistlib
-import sched, time
-import requests
+import select, time
 from sys import argv, maxsize, stdout
 import argparse
 from os import environ
 from itertools import cycle
-import http.client, urllib
-import pdb
+import urllib, urllib.parse
+
+# Splash screen, pre-rendered in figlet's standard font.
+BANNER = r"""
+  _   _       _   _ _____             _ 
+ | \ | | ___ | |_(_)  ___|_      ____| |
+ |  \| |/ _ \| __| | |_  \ \ /\ / / _` |
+ | |\  | (_) | |_| |  _|  \ V  V / (_| |
+ |_| \_|\___/ \__|_|_|     \_/\_/ \__,_|
+
+notifwd by Jordan Mann. Starting up... """
+
+# Absolute paths to the tools we run, resolved once. With an absolute path and
+# close_fds=False, subprocess can use posix_spawn instead of fork+exec.
+_OSASCRIPT = shutil.which("osascript") or "/usr/bin/osascript"
+_MDFIND = shutil.which("mdfind") or "/usr/bin/mdfind"
+_GETCONF = shutil.which("getconf") or "/usr/bin/getconf"
+
+# Seconds between the Unix epoch and the Cocoa Core Data epoch (Jan 1 2001).
+_COCOA_EPOCH = 978307200.0
 
 # I have been writing a lot of Java and am probably not supposed to
 # put everything into one class like this.
 class Notification:
-    
+
+    # Display names already resolved by mdfind, keyed by bundle identifier.
+    # Persisted between runs so restarts don't have to warm it up again.
+    _app_name_cache = {}
+    APP_NAME_CACHE_PATH = os.path.expanduser("~/.cache/notifwd/appnames.json")
+
+    PUSHOVER_URL = "https://api.pushover.net/1/messages.json"
+    # PushOver rejects messages longer than this.
+    PUSHOVER_MAX_MESSAGE = 1024
+
+    # ID and date of the newest notification we've already seen.
+    last_id = 0
+    last_date = 0
+    # Highest rec_id in the table at the last check, to skip idle wake-ups cheaply.
+    _last_max_id = None
+
+    # kqueue watching the database files, and the descriptors it watches.
+    _kqueue = None
+    _watched_fds = []
+
+    # PyObjC's Foundation module, if it's installed, to decode plists natively.
+    # None until load_plist first looks for it, False if it isn't available.
+    _foundation = None
+
     @staticmethod
     def setup(argv):
         # Parse the command-line arguments.
@@ -37,7 +79,7 @@ class Notification:
                             default=environ.get("PUSHOVER_USER_KEY"))
 
         parser.add_argument("--frequency", "-f", type=int,
-                            help="Frequency, in seconds, to check for new notifications.",
+                            help="Longest time, in seconds, to go without checking for new notifications.",
                             default=60)
         parser.add_argument("--version", action="store_true",
                             help="Get program version")
@@ -61,84 +103,195 @@ class Notification:
         Notification.FREQ = args.frequency
         Notification.SILENT = args.silent
         Notification.TEST = args.test
-        if not Notification.SILENT: print("""
-  _   _       _   _ _____             _ 
- | \ | | ___ | |_(_)  ___|_      ____| |
- |  \| |/ _ \| __| | |_  \ \ /\ / / _` |
- | |\  | (_) | |_| |  _|  \ V  V / (_| |
- |_| \_|\___/ \__|_|_|     \_/\_/ \__,_|
-
-notifwd by Jordan Mann. Starting up... """, end="")
+        Notification.load_app_name_cache()
+        import concurrent.futures
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        # Reuse one connection to PushOver, rather than a new TCP and TLS handshake per notification.
+        Notification.session = requests.Session()
+        Notification.session.headers.update({"User-Agent": "notifwd/%s" % __version__})
+        Notification.session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4,
+                                                           max_retries=Retry(total=2, backoff_factor=0.2)))
+        # Send from worker threads, so a slow PushOver never holds up reading the database.
+        Notification._send_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="notif-send")
+        if not Notification.SILENT: print(BANNER, end="")
         # Get the system temp directory macOS is caching to.
-        tmp_path = subprocess.run(["getconf", "DARWIN_USER_DIR"], stdout=subprocess.PIPE).stdout
-        # Locate the database; start SQLite.
-        db_path = tmp_path.decode("utf-8").rstrip() + "com.apple.NotificationCenter/db2/db"
-        db_path_fails = subprocess.run(["stat", db_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
-        if (db_path_fails):
-            db_path = tmp_path.decode("utf-8").rstrip() + "com.apple.notificationcenter/db2/db"
-        Notification.connection = sqlite3.connect(db_path)
+        tmp_path = Notification.darwin_user_dir()
+        # Locate the database (its directory's capitalization varies between macOS versions); start SQLite.
+        db_path = next((path for path in (tmp_path + "com.apple.NotificationCenter/db2/db",
+                                          tmp_path + "com.apple.notificationcenter/db2/db")
+                        if os.path.exists(path)), None)
+        if db_path is None:
+            raise SystemExit("\nCouldn't find the Notification Center database in %s" % tmp_path)
+        # We only ever read Apple's database, so open it read-only and let SQLite
+        # serve pages from mmap rather than copying them into its own cache.
+        # (Not immutable=1: NotificationCenter keeps writing to it while we run.)
+        # Our queries are fixed strings with ? placeholders, so their prepared statements stay cached.
+        Notification.db_path = db_path
+        Notification.connection = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(db_path),
+                                                  uri=True, isolation_level=None, cached_statements=128)
+        Notification.connection.executescript("PRAGMA mmap_size=67108864; PRAGMA cache_size=-8192;"
+                                              " PRAGMA temp_store=MEMORY; PRAGMA query_only=1;")
+        Notification.connection.row_factory = sqlite3.Row
         Notification.cursor = Notification.connection.cursor()
         # Set the most recent notification ID to the ID of the last-displayed notification.
-        last_data = Notification.get_notification_data(0)
+        last_data = Notification.get_latest_id()
         if last_data:
-            Notification.last_id = last_data[0]
-            Notification.last_date = last_data[6]
+            Notification.last_id = last_data["rec_id"]
+            Notification.last_date = (last_data["delivered_date"] if last_data["delivered_date"] != None else last_data["request_date"])
         if Notification.TEST:
             print("Sending test notification... ", end="")
-            subprocess.run(["osascript", "-e", "display notification time string of (current date) with title \"The time is\" subtitle \"Most definitely\""])
+            subprocess.run([_OSASCRIPT, "-e", "display notification time string of (current date) with title \"The time is\" subtitle \"Most definitely\""],
+                           close_fds=False)
         if not Notification.SILENT: print("done.")
 
     @staticmethod
     def main(argv):
         Notification.setup(argv)
-        s = sched.scheduler(time.time, time.sleep)
         #https://stackoverflow.com/a/22616059/9068081
         spinner = cycle(['*','-', '/', '|', '\\','-','*'])
-        def scheduled_update(s):
-            if not Notification.SILENT:
-                    for i in range(0,7):
-                        time.sleep(0.1)
-                        stdout.write(next(spinner))
-                        stdout.flush()
-                        stdout.write('\b')
-
-            Notification.check()
-            # Schedule to run periodically.
-            s.enter(Notification.FREQ - 0.7, 1, scheduled_update, (s,))
-        # Schedule to run on start.
-        s.enter(0, 1, scheduled_update, (s,))
+        last_spin = 0
         try:
-            print("Starting scheduler. Update frequency is %d second%s. " % (Notification.FREQ, ("s" if Notification.FREQ != 1 else "")), end="")
+            print("Watching for notifications. Checking at least every %d second%s. " % (Notification.FREQ, ("s" if Notification.FREQ != 1 else "")), end="")
             stdout.flush() # See note above.
-            s.run()
+            # Start watching before the first check, so nothing written during it goes unnoticed.
+            Notification.watch_database()
+            while True:
+                # One write per frame, and at most four frames a second during a burst.
+                if not Notification.SILENT and time.monotonic() - last_spin >= 0.25:
+                    last_spin = time.monotonic()
+                    stdout.write(next(spinner) + '\b')
+                    stdout.flush()
+                Notification.check()
+                Notification.wait_for_change()
         except KeyboardInterrupt:
             print("\nQuitting...")
+            Notification.unwatch_database()
             Notification.connection.close()
+            # Let anything already queued finish sending.
+            Notification._send_pool.shutdown(wait=True)
+            Notification.session.close()
+            Notification.save_app_name_cache()
             raise SystemExit # Equivalent to quit() or exit()
         except Exception as e:
             raise(e)
 
+    # Find the per-user directory macOS caches to (what `getconf DARWIN_USER_DIR` prints),
+    # without forking a process for it if we can help it.
+    # $TMPDIR is its sibling: /var/folders/xx/yyyy/T/ vs. /var/folders/xx/yyyy/0/
+    @staticmethod
+    def darwin_user_dir():
+        if "CS_DARWIN_USER_DIR" in os.confstr_names:
+            return os.confstr("CS_DARWIN_USER_DIR")
+        tmpdir = environ.get("TMPDIR", "").rstrip("/")
+        if tmpdir.startswith("/var/folders/") and tmpdir.endswith("/T"):
+            return tmpdir[:-1] + "0/"
+        return subprocess.run([_GETCONF, "DARWIN_USER_DIR"], capture_output=True, text=True, encoding="utf-8",
+                              close_fds=False).stdout.rstrip()
+
+    # Watch the database, and the write-ahead log where most writes actually land,
+    # so we wake up as soon as NotificationCenter records something.
+    @staticmethod
+    def watch_database():
+        Notification.unwatch_database()
+        Notification._kqueue = select.kqueue()
+        events = []
+        for path in (Notification.db_path, Notification.db_path + "-wal"):
+            try:
+                fd = os.open(path, getattr(os, "O_EVTONLY", os.O_RDONLY))
+            except OSError:
+                continue
+            Notification._watched_fds.append(fd)
+            events.append(select.kevent(fd, filter=select.KQ_FILTER_VNODE,
+                                        flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                                        fflags=select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND
+                                        | select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME))
+        Notification._kqueue.control(events, 0, 0)
+
+    @staticmethod
+    def unwatch_database():
+        if Notification._kqueue is not None:
+            Notification._kqueue.close()
+            Notification._kqueue = None
+        for fd in Notification._watched_fds:
+            os.close(fd)
+        Notification._watched_fds = []
+
+    # Block until the database changes, or FREQ seconds pass as a safety net.
+    @staticmethod
+    def wait_for_change():
+        if Notification._kqueue is None:
+            Notification.watch_database()
+        events = Notification._kqueue.control(None, len(Notification._watched_fds) or 1, Notification.FREQ)
+        # The log comes and goes with checkpoints, so re-open the watches when
+        # a file was replaced, or when we timed out and may have missed one appearing.
+        if not events or any(e.fflags & (select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME) for e in events):
+            Notification.watch_database()
+
     # Create current Cocoa Core Data Timestamp (seconds since Jan 1 2001)
     # and subtract notification date to find how many seconds ago it was.
     # https://www.epochconverter.com/coredata
     @staticmethod
     def coredata_now():
-        return (datetime.utcnow() - datetime(2001,1,1)).total_seconds()
+        return time.time() - _COCOA_EPOCH
+
+    # Fetch the ID and date of the newest notification in the database.
+    @staticmethod
+    def get_latest_id():
+        return Notification.cursor.execute(
+            "SELECT rec_id, delivered_date, request_date FROM record ORDER BY rec_id DESC LIMIT 1").fetchone()
 
-    # Fetch data for a specific notification from the database.
+    # Stream every notification recorded since the last one we saw, oldest first.
+    # rec_id only ever grows, so this is a range scan on the primary key with no sorting.
+    # Either delivered_date or request_date will be filled in.
     @staticmethod
-    def get_notification_data(n):
-        #return Notification.cursor.execute("SELECT *, NTH_VALUE(rec_id,%d) OVER (ORDER BY rec_id DESC) FROM record LIMIT 1" % (n + 1)).fetchone()
-        # I know there is a better way to do this, but I've spent an hour with my limited SQLite knowledge and it isn't enough.
-        return Notification.cursor.execute("SELECT * FROM (SELECT * FROM record ORDER BY rec_id DESC LIMIT %d) ORDER BY rec_id LIMIT 1" % (n + 1)).fetchone()
-    
+    def get_new_rows(last_id, last_date):
+        return Notification.cursor.execute(
+            "SELECT rec_id, data, delivered_date, request_date FROM record"
+            " WHERE rec_id > ? AND COALESCE(delivered_date, request_date) >= ?"
+            " ORDER BY rec_id", (last_id, last_date))
+
     # Get an application name like "Messages" from an identifier like "com.apple.Messages"
     # that comes with the notification.
+    # Results are cached, since the same few apps send almost every notification.
     @staticmethod
     def lookup_display_name(identifier):
-        return subprocess.run(["mdfind", "kMDItemCFBundleIdentifier", "=",
+        cached = Notification._app_name_cache.get(identifier)
+        if cached:
+            return cached
+        name = subprocess.run([_MDFIND, "kMDItemCFBundleIdentifier", "=",
                                identifier.strip(), "-attr", "kMDItemDisplayName"],
-                              stdout=subprocess.PIPE).stdout.decode("utf-8").split(" = ")[-1].strip()
+                              capture_output=True, text=True, encoding="utf-8",
+                              close_fds=False).stdout.rsplit(" = ", 1)[-1].strip()
+        # Spotlight finds nothing while it's re-indexing or for a freshly installed app,
+        # so only remember real names and ask again next time.
+        if name:
+            Notification._app_name_cache[identifier] = name
+        return name
+
+    # Reload display names saved by a previous run, if there are any.
+    @staticmethod
+    def load_app_name_cache():
+        try:
+            with open(Notification.APP_NAME_CACHE_PATH) as f:
+                loaded = json.load(f)
+        except (OSError, ValueError):
+            return
+        # Ignore a file that isn't ours, and any empty names an older version saved.
+        if isinstance(loaded, dict):
+            Notification._app_name_cache.update(
+                (identifier, name) for identifier, name in loaded.items() if name and isinstance(name, str))
+
+    # Save display names for the next run. Failing to save isn't worth crashing over.
+    @staticmethod
+    def save_app_name_cache():
+        try:
+            os.makedirs(os.path.dirname(Notification.APP_NAME_CACHE_PATH), exist_ok=True)
+            with open(Notification.APP_NAME_CACHE_PATH, "w") as f:
+                json.dump(Notification._app_name_cache, f)
+        except OSError:
+            pass
 
     # Inititialize nonstatic Notification attributes.
     def __init__(self):
@@ -161,56 +314,86 @@ notifwd by Jordan Mann. Starting up... """, end="")
     # Collect recent notifications.
     @staticmethod
     def check():
+        # Nothing was added since last time; don't bother scanning.
+        max_id = Notification.cursor.execute("SELECT max(rec_id) FROM record").fetchone()[0]
+        if max_id == Notification._last_max_id:
+            return
+        Notification._last_max_id = max_id
         # Oh, I've figured it out. We need to cross-check by timestamps, or dismissed notifications cause the system to never encounter into last_id.
-        n = 0
-        sql_data = Notification.get_notification_data(n)
-        if sql_data:
-            newest_id = sql_data[0]
-            # Either delivered_date or request_date will be filled in. Don't yet want to peek into what those mean.
-            newest_date = (sql_data[6] if sql_data[6] != None else sql_data[4])
-            # print("DEBUG", (sql_data[6] if sql_data[6] != None else sql_data[4]), Notification.last_date)
-            while sql_data[0] != Notification.last_id and (sql_data[6] if sql_data[6] != None else sql_data[4]) >= Notification.last_date:
-                # print("N is ", n, "last id", Notification.last_id, "newest id", newest_id, "this id", sql_data[0])
-                Notification.send(Notification.parse_notification(sql_data[3]))
-                n += 1
-                sql_data = Notification.get_notification_data(n)
-            Notification.last_id = newest_id
-            Notification.last_date = newest_date
+        # Group a burst by app, so it goes out as one message per app instead of one per notification.
+        batches = {}
+        last_row = None
+        for row in Notification.get_new_rows(Notification.last_id, Notification.last_date):
+            notification = Notification.parse_notification(row["data"])
+            batches.setdefault(notification.app, []).append(notification)
+            last_row = row
+        for app, items in batches.items():
+            Notification.send_batch(app, items)
+        if last_row is not None:
+            Notification.last_id = last_row["rec_id"]
+            Notification.last_date = (last_row["delivered_date"] if last_row["delivered_date"] != None else last_row["request_date"])
+
+    # Decode an Apple binary plist, natively if we can.
+    @staticmethod
+    def load_plist(raw_plist):
+        if Notification._foundation is None:
+            try:
+                import Foundation
+                Notification._foundation = Foundation
+            except ImportError:
+                Notification._foundation = False
+        if Notification._foundation:
+            data, _, _ = Notification._foundation.NSPropertyListSerialization.propertyListWithData_options_format_error_(
+                raw_plist, 0, None, None)
+            if data is not None:
+                return data
+        return plistlib.loads(raw_plist)
 
     # Create a notification from raw plist data. The returned notification can then be sent.
     @staticmethod
     def parse_notification(raw_plist):
         this = Notification()
         # Parse raw database data, which is an Apple plist.
-        data = plistlib.loads(raw_plist)
-        for key, value in data.items():
-            if key == "app":
-                this.identifier = value or ""
-                this.app = Notification.lookup_display_name(value) or ""
-            elif key == "date":
-                this.date = float(value)
-                this.ago = Notification.coredata_now() - float(value)
-            elif key == "req":
-                for subkey, subvalue in value.items():
-                    if subkey == "titl":
-                        this.title = subvalue or ""
-                    if subkey == "subt":
-                        this.subtitle = subvalue or ""
-                    if subkey == "body":
-                        this.body = subvalue or ""
+        data = Notification.load_plist(raw_plist)
+        this.identifier = data.get("app") or ""
+        if this.identifier:
+            this.app = Notification.lookup_display_name(this.identifier) or ""
+        date = data.get("date")
+        if date is not None:
+            this.date = float(date)
+            this.ago = Notification.coredata_now() - this.date
+        req = data.get("req") or {}
+        this.title = req.get("titl") or ""
+        this.subtitle = req.get("subt") or ""
+        this.body = req.get("body") or ""
         # Merge subtitle and body - yes, notifications have three lines.
         this.text = this.subtitle + ("\u2014" if this.subtitle else "") + this.body
         return this
 
-    # Send a notification to the Prowl API.
-    def send(self):
-        if not Notification.SILENT: print("\nSending notification from", self)
+    # Send one or more notifications from the same app to the PushOver API, as a single message, in the background.
+    @staticmethod
+    def send_batch(app, items):
+        if not Notification.SILENT:
+            for item in items: print("\nSending notification from", item)
+        if len(items) == 1:
+            message = f"{app}: {items[0].title} \n {items[0].text}"
+        else:
+            message = f"{app}:\n" + "\n---\n".join(f"{item.title}: {item.text}" for item in items)
+        Notification._send_pool.submit(Notification._send_blocking, app, message[:Notification.PUSHOVER_MAX_MESSAGE])
 
-        r = requests.post("https://api.pushover.net/1/messages.json",
-                            data={  "token": Notification.API_KEY,
-                                    "user": Notification.USER_KEY,
-                                    "message": f"{self.app}: {self.title} \n {self.text}",
-                        } )
+    # The actual request. Runs on a send thread, where nobody would see an exception, so report errors here.
+    @staticmethod
+    def _send_blocking(app, message):
+        import requests
+        try:
+            r = Notification.session.post(Notification.PUSHOVER_URL, timeout=10,
+                                data={  "token": Notification.API_KEY,
+                                        "user": Notification.USER_KEY,
+                                        "message": message,
+                            } )
+        except requests.RequestException as e:
+            print("Failed to send notification from", app, "-", e)
+            return
 
         if r.status_code != 200:
             print("Received unexpected status code", r.status_code, r.reason, "response:\n", r.text)